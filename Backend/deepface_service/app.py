@@ -16,34 +16,95 @@ import os
 # Enable GPU and optimize TensorFlow BEFORE importing
 os.environ["TF_CPP_MIN_LOG_LEVEL"] = "2"  # Suppress TF warnings
 os.environ["CUDA_VISIBLE_DEVICES"] = "0"  # Use first GPU
-# Enable deterministic operations for consistent results
-os.environ["TF_DETERMINISTIC_OPS"] = "1"
-os.environ["TF_CUDNN_DETERMINISTIC"] = "1"
-
-from flask import Flask, request, jsonify
+# Deterministic ops force slower cuDNN conv algorithms and disable autotuning.
+# Weights are fixed, so embeddings are already stable for matching; opt in with
+# SNAPTICK_DETERMINISTIC=1 only when bit-identical output is needed (debugging).
+# For byte-stable vectors across hardware, compare np.round(embedding, 5).
+DETERMINISTIC = os.environ.get("SNAPTICK_DETERMINISTIC") == "1"
+if DETERMINISTIC:
+    os.environ["TF_DETERMINISTIC_OPS"] = "1"
+    os.environ["TF_CUDNN_DETERMINISTIC"] = "1"
+
+from flask import Flask, Request, Response, request, jsonify
 from deepface import DeepFace
+from deepface.modules.verification import find_threshold
 import numpy as np
 import cv2
+import orjson
 import base64
+import binascii
+import hashlib
+import io
+import json
+import queue
+import threading
+import time
 import traceback
+from collections import OrderedDict
+from contextlib import nullcontext
+from concurrent.futures import Future, ThreadPoolExecutor
+from PIL import Image
+
+# Optional CPU pinning, e.g. CPU_AFFINITY=0-3 or 0,2 (Linux only)
+CPU_AFFINITY = os.environ.get("CPU_AFFINITY", "")
+if CPU_AFFINITY and hasattr(os, "sched_setaffinity"):
+    try:
+        cores = set()
+        for part in CPU_AFFINITY.split(","):
+            first, _, last = part.partition("-")
+            cores.update(range(int(first), int(last or first) + 1))
+        os.sched_setaffinity(0, cores)
+        print(f"Pinned to CPU cores {sorted(cores)}")
+    except Exception as e:
+        print(f"CPU affinity note: {e}")
+
+# TF sizes its thread pools to every core by default; with gunicorn request
+# threads detecting in parallel that oversubscribes the CPU. Set these to split
+# the cores instead (0 = TF default), e.g. TF_INTRA_OP_THREADS=2 TF_INTER_OP_THREADS=1.
+TF_INTRA_OP_THREADS = int(os.environ.get("TF_INTRA_OP_THREADS", "0"))
+TF_INTER_OP_THREADS = int(os.environ.get("TF_INTER_OP_THREADS", "0"))
 
-# Check GPU availability and enable deterministic mode
+# Memory growth still lets TF keep growing into the whole GPU over time. Set
+# TF_GPU_MEM_MB to cap it instead, leaving a known budget for the ONNX Runtime /
+# TensorRT ArcFace session sharing the device.
+TF_GPU_MEM_MB = int(os.environ.get("TF_GPU_MEM_MB", "0"))
+
+# Check GPU availability and optionally enable deterministic mode
 try:
     import tensorflow as tf
-    # Enable deterministic behavior for reproducible results
-    tf.config.experimental.enable_op_determinism()
+    # Must run before TF initializes its runtime (first op or device query)
+    if TF_INTRA_OP_THREADS:
+        tf.config.threading.set_intra_op_parallelism_threads(TF_INTRA_OP_THREADS)
+    if TF_INTER_OP_THREADS:
+        tf.config.threading.set_inter_op_parallelism_threads(TF_INTER_OP_THREADS)
+    if DETERMINISTIC:
+        tf.config.experimental.enable_op_determinism()
+        print("TensorFlow deterministic mode enabled")
     gpus = tf.config.list_physical_devices('GPU')
     if gpus:
         print(f"GPU detected: {gpus}")
         for gpu in gpus:
-            tf.config.experimental.set_memory_growth(gpu, True)
+            if TF_GPU_MEM_MB:
+                tf.config.set_logical_device_configuration(
+                    gpu, [tf.config.LogicalDeviceConfiguration(memory_limit=TF_GPU_MEM_MB)]
+                )
+            else:
+                tf.config.experimental.set_memory_growth(gpu, True)
+        if TF_GPU_MEM_MB:
+            print(f"TensorFlow GPU memory limited to {TF_GPU_MEM_MB} MB per device")
     else:
         print("No GPU detected, using CPU (RetinaFace may be slow)")
-    print("TensorFlow deterministic mode enabled for consistent results")
 except Exception as e:
-    print(f"GPU/deterministic setup note: {e}")
+    print(f"TensorFlow setup note: {e}")
+
+class ServiceRequest(Request):
+    # The enrolled gallery arrives as one multipart text field (a few MB per
+    # class); Werkzeug would reject any form field over 500 KB
+    max_form_memory_size = 64 * 1024 * 1024
+
 
 app = Flask(__name__)
+app.request_class = ServiceRequest
 
 # =============================================================================
 # MODEL CONFIGURATION - ArcFace + RetinaFace (Industry Standard)
@@ -54,6 +115,15 @@ MODEL_NAME = "ArcFace"
 DETECTOR_BACKEND = os.environ.get("DETECTOR_BACKEND", "retinaface")
 DISTANCE_METRIC = "cosine"
 
+# Optional fast first tier for single-face enrollment photos (e.g. "yunet",
+# ~1-5 ms on CPU vs 30-80 ms for RetinaFace). Used only when it finds exactly
+# one confident, reasonably large face; anything else falls back to
+# DETECTOR_BACKEND. Its boxes/eye points differ slightly from RetinaFace's, so
+# embeddings are close but not identical to a RetinaFace enrollment.
+FAST_DETECTOR_BACKEND = os.environ.get("FAST_DETECTOR_BACKEND", "")
+FAST_DETECT_MIN_CONFIDENCE = 0.9
+FAST_DETECT_MIN_FACE_FRACTION = 0.03  # Face box area relative to the image
+
 # Threshold for ArcFace with cosine distance
 # ArcFace embeddings: same person usually 0.0 - 0.55, different person 0.6+
 # DeepFace default for ArcFace+cosine is 0.68
@@ -61,30 +131,537 @@ DISTANCE_METRIC = "cosine"
 # TUNING: 0.60 gives good balance for most classroom scenarios
 FACE_MATCH_THRESHOLD = 0.60  # Balanced threshold
 FACE_MATCH_GAP = 0.05  # Require clear separation to avoid matching wrong person
+MATCH_TOP_K = 5  # Closest enrolled people kept per face (best, second best, logs)
 
 print(f"DeepFace Service starting with model: {MODEL_NAME}, detector: {DETECTOR_BACKEND}")
 print(f"Thresholds: match <= {FACE_MATCH_THRESHOLD}, max gap >= {FACE_MATCH_GAP}")
 print(f"Using adaptive gap: confident matches need less gap, borderline matches need more")
 
+# =============================================================================
+# MODEL RUNTIME - Detection and embedding as separate stages
+# =============================================================================
+# DeepFace.represent() re-runs model lookup, detection, alignment and one ArcFace
+# forward pass per face on every call. We build ArcFace once, detect/align with
+# DeepFace.extract_faces() and embed all faces of an image in a single batch.
+#
+# Optional: export ArcFace with export_onnx.py to serve the forward pass through
+# ONNX Runtime (TensorRT FP16 > CUDA > CPU providers). An arcface.onnx next to
+# this file is used automatically (the Docker image exports one at build time);
+# ARCFACE_ONNX_PATH points elsewhere, or disables it when set to "".
+ARCFACE_ONNX_DEFAULT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "arcface.onnx")
+ARCFACE_ONNX_PATH = os.environ.get(
+    "ARCFACE_ONNX_PATH", ARCFACE_ONNX_DEFAULT if os.path.isfile(ARCFACE_ONNX_DEFAULT) else ""
+)
+ARCFACE_ONNX_INPUT = "input"  # Input name set by export_onnx.py
+# Replay single-face embeddings from a captured CUDA graph (needs ONNX + CUDA GPU)
+ARCFACE_CUDA_GRAPH = os.environ.get("ARCFACE_CUDA_GRAPH", "0") == "1"
+ARCFACE_MAX_BATCH = 32  # Largest forward pass (TensorRT profile max)
+# XLA-compile the Keras forward pass. Compiles once per batch size, so the first
+# request with a new face count pays a few seconds - enable for steady workloads.
+ARCFACE_XLA = os.environ.get("ARCFACE_XLA", "0") == "1"
+
+# Micro-batching: faces from concurrent requests share one forward pass.
+# A request waits at most EMBED_BATCH_WAIT_MS for others to join its batch.
+EMBED_MAX_BATCH = int(os.environ.get("EMBED_MAX_BATCH", "16"))
+EMBED_BATCH_WAIT_MS = float(os.environ.get("EMBED_BATCH_WAIT_MS", "5"))
+# Batches in flight at once. On a GPU, 2 lets the next batch be gathered and
+# copied to the device while the current one runs (TF/ORT issue copies on their
+# own streams); on CPU a second worker only competes for the same cores.
+EMBED_WORKERS = int(os.environ.get("EMBED_WORKERS", "1"))
+
+# Detect + align results are cached by image content so retried requests for
+# the same photo (e.g. /verify of one selfie against several candidates) only
+# pay for the ArcFace pass. ~75 KB per face, so 40 MB holds ~500 faces.
+ALIGNED_FACE_CACHE_MB = float(os.environ.get("ALIGNED_FACE_CACHE_MB", "40"))
+
+# Detector passes running at once across request threads. ArcFace is already
+# bounded by EMBED_WORKERS; unbounded RetinaFace calls from 16 gunicorn threads
+# just time-slice the same cores (or GPU) and raise every request's latency.
+# Roughly the core count / TF_INTRA_OP_THREADS on CPU, 1-2 on a single GPU.
+MAX_CONCURRENT_DETECT = int(os.environ.get("MAX_CONCURRENT_DETECT", "2"))
+
+arcface_model = DeepFace.build_model(MODEL_NAME)
+ARCFACE_INPUT_SIZE = tuple(arcface_model.input_shape)  # (112, 112)
+
+
+def compile_arcface_forward():
+    """
+    Trace the Keras ArcFace forward pass into a graph function.
+    The batch dimension is left open so new face counts do not retrace.
+    """
+    h, w = ARCFACE_INPUT_SIZE
+    keras_model = arcface_model.model
+
+    @tf.function(input_signature=[tf.TensorSpec((None, h, w, 3), tf.float32)], jit_compile=ARCFACE_XLA)
+    def forward(faces):
+        return keras_model(faces, training=False)
+
+    return forward
+
+
+arcface_forward = None
+try:
+    arcface_forward = compile_arcface_forward()
+    # Trace now instead of on the first request
+    arcface_forward(np.zeros((1, *ARCFACE_INPUT_SIZE, 3), dtype=np.float32))
+    print(f"ArcFace graph traced (XLA: {ARCFACE_XLA})")
+except Exception as e:
+    arcface_forward = None
+    print(f"ArcFace graph note: {e} - running eagerly")
+
+
+def load_arcface_session(onnx_path):
+    """Create an ONNX Runtime session for the exported ArcFace model.
+    Providers are used in order of preference, skipping those not installed."""
+    import onnxruntime as ort
+
+    h, w = ARCFACE_INPUT_SIZE
+    available = ort.get_available_providers()
+    providers = []
+    if "TensorrtExecutionProvider" in available:
+        # FP16 engine with a profile covering single faces up to a full class photo
+        providers.append(("TensorrtExecutionProvider", {
+            "trt_fp16_enable": True,
+            "trt_engine_cache_enable": True,
+            "trt_engine_cache_path": os.path.join(os.path.dirname(os.path.abspath(onnx_path)), "trt_cache"),
+            "trt_profile_min_shapes": f"{ARCFACE_ONNX_INPUT}:1x{h}x{w}x3",
+            "trt_profile_opt_shapes": f"{ARCFACE_ONNX_INPUT}:8x{h}x{w}x3",
+            "trt_profile_max_shapes": f"{ARCFACE_ONNX_INPUT}:{ARCFACE_MAX_BATCH}x{h}x{w}x3",
+        }))
+    if "CUDAExecutionProvider" in available:
+        # Input shapes are fixed apart from the batch size, so the exhaustive cuDNN
+        # search runs once per batch size and its fastest kernels are reused after
+        providers.append(("CUDAExecutionProvider", {"cudnn_conv_algo_search": "EXHAUSTIVE"}))
+    providers.append("CPUExecutionProvider")
+
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    return ort.InferenceSession(onnx_path, sess_options=options, providers=providers)
+
+
+arcface_session = None
+if ARCFACE_ONNX_PATH:
+    try:
+        arcface_session = load_arcface_session(ARCFACE_ONNX_PATH)
+        print(f"ArcFace ONNX session ready: {arcface_session.get_providers()}")
+    except Exception as e:
+        print(f"ArcFace ONNX setup note: {e} - using Keras model")
+
+
+def load_arcface_graph(onnx_path):
+    """
+    Capture the single-face ArcFace forward pass in a CUDA graph.
+    Input/output live in fixed device buffers, so each call is one H2D copy,
+    one graph replay and one D2H copy instead of hundreds of kernel launches.
+    Returns a function embedding a (1, 112, 112, 3) batch.
+    """
+    import onnxruntime as ort
+
+    session = ort.InferenceSession(
+        onnx_path,
+        providers=[("CUDAExecutionProvider", {"enable_cuda_graph": "1"})]
+    )
+    output = session.get_outputs()[0]
+    h, w = ARCFACE_INPUT_SIZE
+    d_in = ort.OrtValue.ortvalue_from_numpy(np.zeros((1, h, w, 3), np.float32), "cuda", 0)
+    d_out = ort.OrtValue.ortvalue_from_shape_and_type((1, output.shape[-1]), np.float32, "cuda", 0)
+
+    binding = session.io_binding()
+    binding.bind_ortvalue_input(ARCFACE_ONNX_INPUT, d_in)
+    binding.bind_ortvalue_output(output.name, d_out)
+
+    # First run warms up and captures the graph, later runs replay it
+    for _ in range(3):
+        session.run_with_iobinding(binding)
+
+    lock = threading.Lock()  # Buffers are shared, one replay at a time
+
+    def run(face):
+        with lock:
+            d_in.update_inplace(face)
+            session.run_with_iobinding(binding)
+            return d_out.numpy()
 
-def convert_to_native(obj):
-    """Convert numpy types to native Python types for JSON serialization"""
-    if isinstance(obj, dict):
-        return {k: convert_to_native(v) for k, v in obj.items()}
-    elif isinstance(obj, list):
-        return [convert_to_native(i) for i in obj]
-    elif isinstance(obj, np.ndarray):
+    return run
+
+
+arcface_graph = None
+if arcface_session is not None and ARCFACE_CUDA_GRAPH:
+    try:
+        arcface_graph = load_arcface_graph(ARCFACE_ONNX_PATH)
+        print("ArcFace CUDA graph captured for single-face embedding")
+    except Exception as e:
+        print(f"ArcFace CUDA graph note: {e} - using regular execution")
+
+
+# =============================================================================
+# RETINAFACE POST-PROCESSING
+# =============================================================================
+# The retina-face package runs NMS as a pure-Python O(n^2) loop over every
+# proposal and rebuilds the anchor grid for each image. Swap in a vectorized NMS
+# (same keep order and overlap rule) and cache anchor grids per feature-map size.
+ANCHOR_CACHE_SIZE = 64
+
+
+def nms_boxes(dets, threshold):
+    """
+    Greedy non-maximum suppression over (N, 5) [x1, y1, x2, y2, score] rows.
+    Each kept box suppresses the rest in one vectorized step.
+    Returns indices of kept rows, highest score first.
+    """
+    x1, y1, x2, y2, scores = dets[:, 0], dets[:, 1], dets[:, 2], dets[:, 3], dets[:, 4]
+    areas = (x2 - x1 + 1) * (y2 - y1 + 1)
+    order = scores.argsort()[::-1]
+
+    keep = []
+    while order.size > 0:
+        i = order[0]
+        keep.append(i)
+        rest = order[1:]
+        w = np.maximum(0.0, np.minimum(x2[i], x2[rest]) - np.maximum(x1[i], x1[rest]) + 1)
+        h = np.maximum(0.0, np.minimum(y2[i], y2[rest]) - np.maximum(y1[i], y1[rest]) + 1)
+        inter = w * h
+        overlap = inter / (areas[i] + areas[rest] - inter)
+        order = rest[overlap < threshold]
+    return keep
+
+
+def patch_retinaface_postprocess():
+    """Install the vectorized NMS and cached anchors into retina-face"""
+    from retinaface.commons import postprocess
+
+    build_anchors = postprocess.anchors_plane
+    anchor_cache = {}
+
+    def cached_anchors_plane(height, width, stride, base_anchors):
+        key = (height, width, stride, base_anchors.tobytes())
+        anchors = anchor_cache.get(key)
+        if anchors is None:
+            if len(anchor_cache) >= ANCHOR_CACHE_SIZE:
+                anchor_cache.clear()
+            anchors = build_anchors(height, width, stride, base_anchors)
+            anchors.flags.writeable = False  # Shared between requests
+            anchor_cache[key] = anchors
+        return anchors
+
+    postprocess.anchors_plane = cached_anchors_plane
+    postprocess.cpu_nms = nms_boxes
+
+
+try:
+    patch_retinaface_postprocess()
+except Exception as e:
+    print(f"RetinaFace post-processing patch note: {e}")
+
+
+# =============================================================================
+# FACE ALIGNMENT
+# =============================================================================
+# DeepFace aligns each face by rotating the WHOLE photo (PIL, about its centre)
+# and cropping the rotated facial area, so a 40-face class photo costs 40
+# full-image rotations. Warping straight into the crop with the same affine
+# (nearest-neighbour, black fill) gives the same face while only touching
+# those pixels: ~0.05 ms instead of ~15 ms per face on a 1600x1200 photo.
+#
+# Each face is aligned exactly once here; embed_aligned_regions feeds the crops
+# straight to ArcFace without DeepFace re-detecting or re-aligning them. The
+# InsightFace 5-point similarity warp onto the arcface_src template is NOT used:
+# stored descriptors were all produced with DeepFace's eye-level rotation, and
+# embeddings from a different alignment would drift away from every enrollment.
+
+
+def align_face_crop(img, facial_area, left_eye, right_eye, rotate_facial_area):
+    """
+    Crop facial_area (x1, y1, x2, y2) from img rotated so the eyes are level,
+    without rotating the rest of the image. Mirrors DeepFace's align_face
+    followed by the rotated crop in DetectorWrapper.detect_faces.
+    """
+    img_h, img_w = img.shape[:2]
+    angle = 0.0
+    if left_eye is not None and right_eye is not None and img_h > 0 and img_w > 0:
+        angle = float(np.degrees(np.arctan2(right_eye[1] - left_eye[1], right_eye[0] - left_eye[0])))
+
+    x1, y1, x2, y2 = rotate_facial_area(facial_area=facial_area, angle=angle, size=(img_h, img_w))
+    if angle == 0 or x2 <= x1 or y2 <= y1:
+        # A box without area gives the same empty crop as slicing the rotated
+        # image would (warpAffine would read a zero size as the source size)
+        return img[y1:y2, x1:x2]
+
+    # PIL's centre (w/2, h/2) in pixel-edge coordinates is ((w-1)/2, (h-1)/2) for OpenCV.
+    # The crop is sampled from the source image, so faces whose rotated box leaves
+    # the frame stay whole instead of being cut off (or wrapped by negative slicing).
+    matrix = cv2.getRotationMatrix2D(((img_w - 1) / 2, (img_h - 1) / 2), angle, 1.0)
+    matrix[:, 2] -= (x1, y1)
+    return cv2.warpAffine(
+        img, matrix, (x2 - x1, y2 - y1),
+        flags=cv2.INTER_NEAREST, borderMode=cv2.BORDER_CONSTANT, borderValue=0
+    )
+
+
+def patch_deepface_alignment():
+    """Replace DeepFace's detect + align step with per-face affine crops"""
+    from deepface.detectors import DetectorWrapper
+    from deepface.models.Detector import DetectedFace, FacialAreaRegion
+
+    rotate_facial_area = DetectorWrapper.rotate_facial_area
+
+    def detect_faces(detector_backend, img, align=True, expand_percentage=0):
+        face_detector = DetectorWrapper.build_model(detector_backend)
+        expand_percentage = max(expand_percentage, 0)
+
+        results = []
+        for region in face_detector.detect_faces(img=img):
+            x, y, w, h = region.x, region.y, region.w, region.h
+            if expand_percentage > 0:
+                expanded_w = w + int(w * expand_percentage / 100)
+                expanded_h = h + int(h * expand_percentage / 100)
+                x = max(0, x - int((expanded_w - w) / 2))
+                y = max(0, y - int((expanded_h - h) / 2))
+                w = min(img.shape[1] - x, expanded_w)
+                h = min(img.shape[0] - y, expanded_h)
+
+            if align:
+                face = align_face_crop(
+                    img, (x, y, x + w, y + h), region.left_eye, region.right_eye, rotate_facial_area
+                )
+            else:
+                face = img[int(y):int(y + h), int(x):int(x + w)]
+
+            results.append(DetectedFace(
+                img=face,
+                facial_area=FacialAreaRegion(
+                    x=x, y=y, w=w, h=h, confidence=region.confidence,
+                    left_eye=region.left_eye, right_eye=region.right_eye
+                ),
+                confidence=region.confidence
+            ))
+        return results
+
+    DetectorWrapper.detect_faces = detect_faces
+
+
+try:
+    patch_deepface_alignment()
+except Exception as e:
+    print(f"Face alignment patch note: {e}")
+
+
+def json_default(obj):
+    """Fallback for what orjson can't write natively (e.g. non-contiguous arrays)"""
+    if isinstance(obj, np.ndarray):
         return obj.tolist()
-    elif isinstance(obj, np.bool_):
-        return bool(obj)
-    elif isinstance(obj, np.integer):
-        return int(obj)
-    elif isinstance(obj, np.floating):
-        return float(obj)
-    elif isinstance(obj, np.str_):
-        return str(obj)
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
+def json_response(obj, status=200):
+    """
+    Serialize a response with orjson. Numpy arrays and scalars are written
+    directly from C, so embeddings never become lists of Python floats.
+    """
+    return Response(
+        orjson.dumps(obj, default=json_default,
+                     option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS),
+        status=status,
+        mimetype="application/json"
+    )
+
+
+ENROLL_MAX_DIM = 800  # Smaller = faster for enrollment
+
+# JPEGs can be decoded directly at 1/2, 1/4 or 1/8 scale (DCT-domain downscale)
+REDUCED_DECODE_FLAGS = {
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+}
+
+
+def decode_image(buffer, max_dim=None):
+    """
+    Decode an encoded image held in a uint8 buffer.
+    With max_dim, JPEGs are decoded at the smallest reduced scale that still
+    keeps the longest side >= max_dim, skipping most of the decode work for
+    large phone photos. The caller still resizes to the exact size.
+    """
+    flags = cv2.IMREAD_COLOR
+    if max_dim:
+        try:
+            # Only reads the header, pixels are not decoded
+            header = Image.open(io.BytesIO(buffer))
+            if header.format == "JPEG":
+                longest = max(header.size)
+                for factor, reduced_flags in REDUCED_DECODE_FLAGS.items():
+                    if longest // factor >= max_dim:
+                        flags = reduced_flags
+                        break
+        except Exception:
+            pass  # Let cv2 decide whether the data is a valid image
+
+    img = cv2.imdecode(buffer, flags)
+    if img is not None and flags != cv2.IMREAD_COLOR:
+        print(f"[DEBUG] Reduced-size JPEG decode to {img.shape[1]}x{img.shape[0]}")
+    return img
+
+
+def downscale(img, scale):
+    """
+    Shrink by scale (< 1) to the same size cv2.resize(fx=scale) would give.
+    Large reductions first halve with pyrDown (a SIMD 5-tap filter), which is
+    much cheaper per source pixel than a wide INTER_AREA kernel; the final
+    INTER_AREA step then covers at most a 2x reduction.
+    """
+    h, w = img.shape[:2]
+    size = (max(1, round(w * scale)), max(1, round(h * scale)))
+    while img.shape[1] > 2 * size[0] and img.shape[0] > 2 * size[1]:
+        img = cv2.pyrDown(img)
+    return cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+
+
+def resize_to_max_dim(img, max_dim):
+    """Downscale so the longest side is at most max_dim"""
+    h, w = img.shape[:2]
+    if max(h, w) > max_dim:
+        img = downscale(img, max_dim / max(h, w))
+        print(f"[DEBUG] Resized image from {w}x{h} to {img.shape[1]}x{img.shape[0]}")
+    return img
+
+
+# Wire formats for returned embeddings: plain float list, or int8 + scale
+# (L2-normalized, 4x smaller to store/transfer, cosine error ~1e-3)
+EMBEDDING_FORMATS = ("float32", "int8")
+
+
+def quantize_embedding(embedding):
+    """L2-normalize and quantize to int8 with a per-vector scale"""
+    emb = np.asarray(embedding, dtype=np.float32)
+    emb = emb / np.linalg.norm(emb)
+    scale = float(np.abs(emb).max()) / 127.0
+    quantized = np.round(emb / scale).astype(np.int8)
+    return {"int8": base64.b64encode(quantized.tobytes()).decode("ascii"), "scale": scale}
+
+
+def format_embedding(embedding, embedding_format):
+    """Encode an embedding for the response in the requested wire format"""
+    if embedding_format == "int8":
+        return quantize_embedding(embedding)
+    return embedding
+
+
+def decode_descriptor(descriptor):
+    """Enrolled descriptors may be float lists or int8 dicts from embedding_format='int8'"""
+    if isinstance(descriptor, dict):
+        quantized = np.frombuffer(base64.b64decode(descriptor["int8"]), dtype=np.int8)
+        return quantized.astype(np.float32) * np.float32(descriptor["scale"])
+    return descriptor
+
+
+def decode_enrolled_faces(enrolled_faces):
+    """Dequantize any int8 descriptors in place so matching sees plain vectors"""
+    for enrolled in enrolled_faces:
+        enrolled["descriptors"] = [decode_descriptor(d) for d in enrolled.get("descriptors", [])]
+    return enrolled_faces
+
+
+# The same class is matched photo after photo. When enrolled_faces arrives as its
+# own multipart field, the raw JSON is hashed (~1.5 ms/MB) and a repeat skips JSON
+# parsing, int8 decoding and packing (~12 ms/MB for float descriptors).
+ENROLLED_CACHE_SIZE = 8
+
+enrolled_cache = OrderedDict()
+enrolled_cache_lock = threading.Lock()
+
+
+class EnrolledFaces(list):
+    """Decoded enrolled_faces that also memoizes its packed gallery per embedding size"""
+
+    def __init__(self, faces):
+        super().__init__(faces)
+        self.packed = {}
+
+
+def load_enrolled_faces(enrolled_faces):
+    """
+    Decode the 'enrolled_faces' request value: a parsed list (JSON body or the
+    multipart 'data' field) is decoded in place; raw JSON text (multipart
+    'enrolled_faces' field) is cached by content hash across requests.
+    """
+    if not enrolled_faces:
+        return []
+    if not isinstance(enrolled_faces, str):
+        return decode_enrolled_faces(enrolled_faces)
+
+    key = hashlib.blake2b(enrolled_faces.encode(), digest_size=16).digest()
+    with enrolled_cache_lock:
+        cached = enrolled_cache.get(key)
+        if cached is not None:
+            enrolled_cache.move_to_end(key)
+            return cached
+
+    faces = EnrolledFaces(decode_enrolled_faces(json.loads(enrolled_faces)))
+    with enrolled_cache_lock:
+        enrolled_cache[key] = faces
+        while len(enrolled_cache) > ENROLLED_CACHE_SIZE:
+            enrolled_cache.popitem(last=False)
+    return faces
+
+
+def pack_enrolled_faces(enrolled_faces, embedding_dim):
+    """Stack all descriptors of the given size into one L2-normalized (M, D) matrix.
+    Returns (matrix, people, starts); rows starts[i]:starts[i + 1] belong to people[i]."""
+    packed = getattr(enrolled_faces, "packed", None)
+    if packed is not None and embedding_dim in packed:
+        return packed[embedding_dim]
+
+    rows, people, starts = [], [], []
+    mismatched = []  # Roll numbers with descriptors from another model
+    for enrolled in enrolled_faces:
+        all_descriptors = enrolled.get("descriptors", [])
+        descriptors = [d for d in all_descriptors if len(d) == embedding_dim]
+        if len(descriptors) < len(all_descriptors):
+            mismatched.append(enrolled.get("rollNumber"))
+        if not descriptors:
+            continue
+        people.append(enrolled)
+        starts.append(len(rows))
+        rows.extend(descriptors)
+
+    print(f"[DEBUG] Packed {len(rows)} descriptors of {len(people)} enrolled people")
+    if mismatched:
+        # Logged once per gallery: cached galleries are packed only once
+        print(f"[WARN] Found {len(mismatched)} enrolled faces with non-{embedding_dim}-dim embeddings!")
+        print(f"[WARN] These students need to be re-enrolled: {mismatched}")
+        print(f"[WARN] Use POST /enroll/re-embed to update all embeddings with current model")
+
+    matrix = np.array(rows, dtype=np.float32).reshape(len(rows), embedding_dim)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    matrix /= np.where(norms > 0, norms, np.inf)  # All-zero descriptors never match
+    result = (matrix, people, np.array(starts, dtype=np.intp))
+
+    if packed is not None:
+        matrix.setflags(write=False)  # Shared between requests
+        packed[embedding_dim] = result
+    return result
+
+
+def gallery_distances(embeddings, matrix):
+    """Cosine distances (K, M) from K embeddings to every row of a packed gallery,
+    all faces in a photo at once with a single float32 GEMM"""
+    probes = np.array(embeddings, dtype=np.float32).reshape(len(embeddings), matrix.shape[1])
+    probes /= np.linalg.norm(probes, axis=1, keepdims=True)
+    return 1 - probes @ matrix.T
+
+
+def top_k_indices(values, k):
+    """Indices of the k smallest values in ascending order (ties by index),
+    selected with argpartition instead of sorting the whole array"""
+    if len(values) > k:
+        kth = values[np.argpartition(values, k - 1)[k - 1]]
+        candidates = np.flatnonzero(values <= kth)  # Keeps every tie at the cut-off
     else:
-        return obj
+        candidates = np.arange(len(values))
+    return candidates[np.lexsort((candidates, values[candidates]))][:k]
 
 
 def load_image_from_path(image_path, for_group_photo=False):
@@ -106,35 +683,93 @@ def load_image_from_path(image_path, for_group_photo=False):
         else:
             raise FileNotFoundError(f"Image not found: {image_path} (also tried: {alt_path})")
     
-    img = cv2.imread(image_path)
+    # Only resize for single face enrollment, NOT for group photos
+    max_dim = None if for_group_photo else ENROLL_MAX_DIM
+
+    img = decode_image(np.fromfile(image_path, dtype=np.uint8), max_dim)
     if img is None:
         raise ValueError(f"Could not read image: {image_path}")
     
-    # Only resize for single face enrollment, NOT for group photos
-    if not for_group_photo:
-        h, w = img.shape[:2]
-        max_dim = 800  # Smaller = faster for enrollment
-        if max(h, w) > max_dim:
-            scale = max_dim / max(h, w)
-            img = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
-            print(f"[DEBUG] Resized image from {w}x{h} to {img.shape[1]}x{img.shape[0]}")
+    if max_dim:
+        img = resize_to_max_dim(img, max_dim)
     
     return img
 
 
-def load_image_from_base64(base64_string):
-    """Load image from base64 string"""
-    img_data = base64.b64decode(base64_string)
-    nparr = np.frombuffer(img_data, np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+def load_image_from_bytes(image_bytes, max_dim=None):
+    """Load image from raw encoded bytes. Pass max_dim to downscale single-face images."""
+    img = decode_image(np.frombuffer(image_bytes, np.uint8), max_dim)
     if img is None:
+        raise ValueError("Could not decode image")
+    if max_dim:
+        img = resize_to_max_dim(img, max_dim)
+    return img  # Group photos stay original, preprocess only for detection
+
+
+def load_image_from_base64(base64_string, max_dim=None):
+    """
+    Load image from base64 string. Pass max_dim to downscale single-face images.
+    Accepts data URLs and unpadded input; the decoded bytes go straight to
+    imdecode through a zero-copy view. EXIF orientation is still applied.
+    """
+    if base64_string.startswith("data:"):
+        base64_string = base64_string.partition(",")[2]
+    missing_padding = -len(base64_string) % 4
+    if missing_padding:
+        base64_string += "=" * missing_padding
+    try:
+        # a2b_base64 directly: b64decode only adds a wrapper and an ASCII re-encode
+        return load_image_from_bytes(binascii.a2b_base64(base64_string), max_dim)
+    except ValueError:  # binascii.Error is a ValueError too
         raise ValueError("Could not decode base64 image")
-    return img  # Return original, preprocess only for detection
+
+
+def get_request_payload():
+    """
+    Parse the request into (data, images).
+    Images can be uploaded without base64 (33% smaller, no decode pass):
+    - raw body with Content-Type image/* or application/octet-stream,
+      options in the query string; the image is images["image"]
+    - multipart/form-data with file parts (image, or image1/image2 for /verify),
+      options as form fields or as a JSON 'data' field; an 'enrolled_faces'
+      form field is kept as raw JSON text for the cache in load_enrolled_faces
+    Otherwise data is the JSON body as before and images is empty.
+    """
+    mimetype = request.mimetype or ""
+    if mimetype.startswith("image/") or mimetype == "application/octet-stream":
+        return request.args.to_dict(), {"image": request.get_data(cache=False)}
+    if mimetype == "multipart/form-data":
+        data = request.form.to_dict()
+        if "data" in data:
+            data.update(json.loads(data.pop("data")))
+        images = {name: file.read() for name, file in request.files.items()}
+        return data, images
+    return request.get_json() or {}, {}
+
+
+# cv2.CLAHE keeps scratch buffers between apply() calls, so each request thread
+# gets its own set instead of building one per request
+CLAHE_CLIP_LIMITS = (2.0, 3.0, 4.0)
+clahe_local = threading.local()
+
+
+def get_clahe(clip_limit):
+    """Return this thread's CLAHE (8x8 tiles) for one of CLAHE_CLIP_LIMITS"""
+    pool = getattr(clahe_local, "pool", None)
+    if pool is None:
+        pool = {
+            limit: cv2.createCLAHE(clipLimit=limit, tileGridSize=(8, 8))
+            for limit in CLAHE_CLIP_LIMITS
+        }
+        clahe_local.pool = pool
+    return pool[clip_limit]
 
 
 def preprocess_for_detection(img):
     """Preprocess image to improve face detection in challenging conditions.
-    Applies adaptive enhancement based on image brightness."""
+    Applies adaptive enhancement based on image brightness.
+    Returns (img, scale, stats) where stats holds the brightness 'mean' and
+    'std' of the input and whether 'clahe' was applied."""
     original_h, original_w = img.shape[:2]
     scale = 1.0
     
@@ -143,21 +778,26 @@ def preprocess_for_detection(img):
     max_dim = 1600
     if max(original_h, original_w) > max_dim:
         scale = max_dim / max(original_h, original_w)
-        img = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        img = downscale(img, scale)
         print(f"[DEBUG] Resized group photo from {original_w}x{original_h} to {img.shape[1]}x{img.shape[0]}")
     
-    # Check if image needs enhancement (low brightness)
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    mean_brightness = np.mean(gray)
-    std_brightness = np.std(gray)
+    # Check if image needs enhancement (low brightness). The probe only feeds a
+    # threshold, so measure it on every 4th pixel (a strided view, no resize).
+    # A point sample keeps the std; area averaging would smooth it below the
+    # CLAHE gate. Same pixels as gray[::4, ::4], but only those get converted
+    gray = cv2.cvtColor(img[::4, ::4], cv2.COLOR_BGR2GRAY)
+    mean, std = cv2.meanStdDev(gray)  # One pass; np.std would re-read for the mean
+    mean_brightness = float(mean[0, 0])
+    std_brightness = float(std[0, 0])
     
     print(f"[DEBUG] Image brightness: mean={mean_brightness:.1f}, std={std_brightness:.1f}")
+    stats = {"mean": mean_brightness, "std": std_brightness, "clahe": False}
     
     # Apply CLAHE for dark or low-contrast images
     if mean_brightness < 100 or std_brightness < 40:
-        # Convert to LAB color space for processing
-        lab = cv2.cvtColor(img, cv2.COLOR_BGR2LAB)
-        l, a, b = cv2.split(lab)
+        # Equalize luma only; YCrCb is a linear 3x3 transform, far cheaper than LAB
+        ycrcb = cv2.cvtColor(img, cv2.COLOR_BGR2YCrCb)
+        y = cv2.extractChannel(ycrcb, 0)
         
         # Adaptive CLAHE based on darkness level
         if mean_brightness < 60:
@@ -167,81 +807,416 @@ def preprocess_for_detection(img):
         else:
             clip_limit = 2.0  # Slightly dark
         
-        clahe = cv2.createCLAHE(clipLimit=clip_limit, tileGridSize=(8, 8))
-        l = clahe.apply(l)
-        
-        # Merge and convert back
-        lab = cv2.merge([l, a, b])
-        img = cv2.cvtColor(lab, cv2.COLOR_LAB2BGR)
+        # apply() works in place on the contiguous Y plane, which is written back
+        # into ycrcb (a strided channel view can't be a cv::Mat destination)
+        get_clahe(clip_limit).apply(y, dst=y)
+        cv2.insertChannel(y, ycrcb, 0)
+        img = cv2.cvtColor(ycrcb, cv2.COLOR_YCrCb2BGR)
         print(f"[DEBUG] Applied CLAHE with clip_limit={clip_limit} (brightness was {mean_brightness:.1f})")
+        stats["clahe"] = True
     
-    return img, scale
+    return img, scale, stats
 
 
-def detect_faces_robust(img, model_name, detector_backend):
+def run_arcface(faces):
+    """Run ArcFace on a (N, 112, 112, 3) float32 batch of aligned BGR faces in [0, 1].
+    Returns a (N, 512) float32 array of embeddings; matching stays in float32 too."""
+    if arcface_graph is not None and len(faces) == 1:
+        return arcface_graph(np.ascontiguousarray(faces))
+    if arcface_session is not None:
+        return np.concatenate([
+            arcface_session.run(None, {ARCFACE_ONNX_INPUT: faces[i:i + ARCFACE_MAX_BATCH]})[0]
+            for i in range(0, len(faces), ARCFACE_MAX_BATCH)
+        ])
+    if arcface_forward is not None:
+        return arcface_forward(faces).numpy()
+    return arcface_model.model(faces, training=False).numpy()
+
+
+class BatchedEmbedder:
     """
-    Detect faces with multiple strategies for better recall.
-    Tries different approaches to maximize face detection.
+    Coalesces faces from concurrent requests into a single ArcFace forward pass.
+    A background thread takes the first waiting request, collects more for up to
+    wait_ms (or until max_batch faces), copies them into a reused input buffer,
+    runs them together and hands each caller its own rows through a Future.
+    With several workers, one gathers the next batch while another is running.
     """
-    all_detections = []
-    seen_faces = set()  # Track detected face regions to avoid duplicates
-    
-    def face_key(fa):
-        """Create a key for deduplicating faces based on position"""
-        x, y, w, h = fa.get("x", 0), fa.get("y", 0), fa.get("w", 0), fa.get("h", 0)
-        # Round to nearest 50 pixels to group nearby detections
-        return (x // 50, y // 50)
-    
-    # Strategy 1: Standard detection
-    try:
-        detections = DeepFace.represent(
+
+    def __init__(self, embed_fn, max_batch, wait_ms, workers=1):
+        self.embed_fn = embed_fn
+        self.max_batch = max_batch
+        self.wait = wait_ms / 1000.0
+        self.requests = queue.Queue()
+        self.workers = [
+            threading.Thread(target=self._run, name=f"arcface-batcher-{i}", daemon=True)
+            for i in range(max(workers, 1))
+        ]
+        for worker in self.workers:
+            worker.start()
+
+    def embed(self, faces):
+        future = Future()
+        self.requests.put((faces, future))
+        return future.result()
+
+    def _run(self):
+        # Batch input buffer owned by this thread, reused across batches and
+        # only reallocated when a larger batch arrives
+        buffer = np.empty((self.max_batch, *ARCFACE_INPUT_SIZE, 3), dtype=np.float32)
+        while True:
+            batch = [self.requests.get()]
+            count = len(batch[0][0])
+            deadline = time.monotonic() + self.wait
+            while count < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.requests.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                batch.append(item)
+                count += len(item[0])
+
+            try:
+                if count > len(buffer):
+                    buffer = np.empty((count, *buffer.shape[1:]), dtype=np.float32)
+                inputs = np.concatenate([faces for faces, _ in batch], out=buffer[:count])
+                embeddings = self.embed_fn(inputs)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            start = 0
+            for faces, future in batch:
+                future.set_result(embeddings[start:start + len(faces)])
+                start += len(faces)
+
+
+embedder = None
+if EMBED_MAX_BATCH > 1:
+    embedder = BatchedEmbedder(run_arcface, EMBED_MAX_BATCH, EMBED_BATCH_WAIT_MS, EMBED_WORKERS)
+    print(f"Embedding micro-batching: up to {EMBED_MAX_BATCH} faces, {EMBED_BATCH_WAIT_MS} ms window, "
+          f"{len(embedder.workers)} worker(s)")
+
+
+def embed_faces(faces):
+    """Embed a batch of aligned faces, sharing the forward pass with concurrent requests"""
+    if embedder is not None:
+        return embedder.embed(faces)
+    return run_arcface(faces)
+
+
+def preprocess_aligned_face(img):
+    """Resize an already cropped and aligned BGR face to the ArcFace input in [0, 1]
+    (same preprocessing as DeepFace.represent with detector_backend='skip')"""
+    h, w = ARCFACE_INPUT_SIZE
+    face = cv2.resize(img, (w, h)).astype(np.float32)
+    face /= 255.0  # In place, no second full-size temporary
+    return face
+
+
+class AlignedFaceCache:
+    """
+    Thread-safe LRU of detect + align results, bounded by the memory of the
+    cached face tensors. Values are (faces, regions) where faces is a read-only
+    (N, 112, 112, 3) float32 array and regions a list of (facial_area, confidence).
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(img, detector_backend, enforce_detection):
+        # Hash the decoded pixels so path, base64 and upscaled inputs all hit
+        digest = hashlib.sha256(np.ascontiguousarray(img)).digest()
+        return digest, img.shape, detector_backend, enforce_detection
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, faces, regions):
+        if faces.nbytes > self.max_bytes:
+            return
+        faces.setflags(write=False)
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = (faces, regions)
+            self.size += faces.nbytes
+            while self.size > self.max_bytes:
+                _, (old_faces, _) = self.entries.popitem(last=False)
+                self.size -= old_faces.nbytes
+
+
+aligned_face_cache = AlignedFaceCache(int(ALIGNED_FACE_CACHE_MB * 1024 * 1024)) if ALIGNED_FACE_CACHE_MB > 0 else None
+detect_semaphore = threading.BoundedSemaphore(max(1, MAX_CONCURRENT_DETECT))
+
+
+def align_faces(img, detector_backend, enforce_detection=False, cache_key=None, slot_held=False):
+    """
+    Detect and align all faces in a BGR image.
+    Returns a (N, 112, 112, 3) float32 batch of BGR faces in [0, 1] and a list of
+    (facial_area, confidence) per face. Results are cached by image content;
+    pass cache_key when AlignedFaceCache.key was already computed for img, and
+    slot_held when the caller already holds a detect_semaphore slot.
+    """
+    key = None
+    if aligned_face_cache is not None:
+        key = cache_key or AlignedFaceCache.key(img, detector_backend, enforce_detection)
+        cached = aligned_face_cache.get(key)
+        if cached is not None:
+            print(f"[DEBUG] Aligned face cache hit ({len(cached[0])} faces)")
+            return cached
+
+    with nullcontext() if slot_held else detect_semaphore:
+        face_objs = DeepFace.extract_faces(
             img_path=img,
-            model_name=model_name,
+            target_size=ARCFACE_INPUT_SIZE,
             detector_backend=detector_backend,
-            enforce_detection=False,
+            enforce_detection=enforce_detection,
             align=True
         )
-        for det in detections:
-            key = face_key(det.get("facial_area", {}))
-            if key not in seen_faces:
-                seen_faces.add(key)
-                all_detections.append(det)
-        print(f"[DEBUG] Strategy 1 (standard): Found {len(detections)} faces")
+    if not face_objs:
+        h, w = ARCFACE_INPUT_SIZE
+        return np.empty((0, h, w, 3), dtype=np.float32), []
+
+    # extract_faces returns RGB crops already scaled to [0, 1] (ArcFace uses no
+    # further normalization); ArcFace is fed BGR like DeepFace.represent does.
+    # The flip is a strided view, so stacking is the only copy.
+    faces = np.stack([obj["face"][:, :, ::-1] for obj in face_objs]).astype(np.float32, copy=False)
+    regions = [(obj["facial_area"], obj["confidence"]) for obj in face_objs]
+
+    if key is not None:
+        aligned_face_cache.put(key, faces, regions)
+    return faces, regions
+
+
+def represent_faces(img, detector_backend, enforce_detection=False):
+    """
+    Batched equivalent of DeepFace.represent(align=True).
+    Detects and aligns all faces once, then embeds them in a single forward pass.
+    """
+    faces, regions = align_faces(img, detector_backend, enforce_detection)
+    return embed_aligned_regions(faces, regions)
+
+
+def embed_aligned_regions(faces, regions):
+    """Embed the output of align_faces into represent_faces-style dicts"""
+    if not regions:
+        return []
+
+    embeddings = embed_faces(faces)
+
+    return [
+        {
+            "embedding": embedding,
+            "facial_area": dict(facial_area),
+            "face_confidence": confidence
+        }
+        for embedding, (facial_area, confidence) in zip(embeddings, regions)
+    ]
+
+
+def serialize_detector(detector_backend):
+    """Build a DeepFace detector and guard it with a lock. OpenCV detectors such as
+    YuNet keep per-call state (input size) and are not safe across request threads."""
+    from deepface.detectors import DetectorWrapper
+
+    detector = DetectorWrapper.build_model(detector_backend)  # Cached by DeepFace
+    detect = detector.detect_faces
+    lock = threading.Lock()
+
+    def locked_detect_faces(img):
+        with lock:
+            return detect(img)
+
+    detector.detect_faces = locked_detect_faces
+
+
+fast_detector_ready = False
+if FAST_DETECTOR_BACKEND:
+    try:
+        serialize_detector(FAST_DETECTOR_BACKEND)
+        fast_detector_ready = True
+        print(f"Fast enrollment detector: {FAST_DETECTOR_BACKEND}")
     except Exception as e:
-        print(f"[DEBUG] Strategy 1 failed: {e}")
-    
-    # Strategy 2: Try with upscaled image if few faces found and image is large enough
-    h, w = img.shape[:2]
-    if len(all_detections) < 3 and max(h, w) < 1200:
+        print(f"Fast detector setup note: {e} - using {DETECTOR_BACKEND} only")
+
+
+def represent_enrollment_face(img):
+    """
+    Embed a single-face enrollment photo (raises ValueError when no face is found).
+    Tries FAST_DETECTOR_BACKEND first and keeps its result only for one confident,
+    large enough face; group shots, small or unsure faces go to DETECTOR_BACKEND.
+    """
+    if fast_detector_ready:
         try:
-            # Upscale by 1.5x to help detect smaller faces
-            upscaled = cv2.resize(img, None, fx=1.5, fy=1.5, interpolation=cv2.INTER_CUBIC)
-            detections = DeepFace.represent(
-                img_path=upscaled,
-                model_name=model_name,
-                detector_backend=detector_backend,
-                enforce_detection=False,
-                align=True
-            )
-            # Scale facial areas back to original size
-            for det in detections:
-                if "facial_area" in det:
-                    fa = det["facial_area"]
-                    det["facial_area"] = {
-                        "x": int(fa.get("x", 0) / 1.5),
-                        "y": int(fa.get("y", 0) / 1.5),
-                        "w": int(fa.get("w", 0) / 1.5),
-                        "h": int(fa.get("h", 0) / 1.5)
-                    }
-                key = face_key(det.get("facial_area", {}))
-                if key not in seen_faces:
-                    seen_faces.add(key)
-                    all_detections.append(det)
-            print(f"[DEBUG] Strategy 2 (upscaled): Found {len(detections)} additional faces")
+            faces, regions = align_faces(img, FAST_DETECTOR_BACKEND, enforce_detection=True)
+        except ValueError:
+            regions = []  # No face found
         except Exception as e:
-            print(f"[DEBUG] Strategy 2 failed: {e}")
+            print(f"[WARN] {FAST_DETECTOR_BACKEND} detection failed: {e}")
+            regions = []
+
+        if len(regions) == 1:
+            facial_area, confidence = regions[0]
+            img_h, img_w = img.shape[:2]
+            face_fraction = facial_area["w"] * facial_area["h"] / float(img_h * img_w)
+            if confidence >= FAST_DETECT_MIN_CONFIDENCE and face_fraction >= FAST_DETECT_MIN_FACE_FRACTION:
+                return embed_aligned_regions(faces, regions)
+        print(f"[DEBUG] {FAST_DETECTOR_BACKEND} found {len(regions)} face(s), falling back to {DETECTOR_BACKEND}")
+
+    return represent_faces(img, DETECTOR_BACKEND, enforce_detection=True)
+
+
+# Boxes from the standard and upscaled passes overlapping more than this are the same face
+DEDUP_IOU_THRESHOLD = 0.5
+UPSCALE_FACTOR = 1.5
+UPSCALE_MIN_BRIGHTNESS = 70
+
+# Runs the upscaled detection pass next to the standard one. Small, so the
+# speculative passes of concurrent requests can't crowd out the request threads
+upscale_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="upscale-detect")
+
+# Final detections with embeddings per photo (~2.5 KB per face). The aligned-face
+# cache already skips RetinaFace for a repeated photo; this also skips ArcFace
+# when /diagnose follows /match-faces on the same image or an upload is retried.
+DETECTION_CACHE_SIZE = int(os.environ.get("DETECTION_CACHE_SIZE", "64"))  # 0 disables
+
+detection_cache = OrderedDict()
+detection_cache_lock = threading.Lock()
+
+
+def detect_upscaled(img, detector_backend, slot_held=False):
+    """Strategy 2: detect on a 1.5x upscaled copy to help with smaller faces.
+    Returns (faces, regions) with facial areas scaled back to img coordinates."""
+    upscaled = cv2.resize(img, None, fx=UPSCALE_FACTOR, fy=UPSCALE_FACTOR, interpolation=cv2.INTER_CUBIC)
+    faces, regions = align_faces(upscaled, detector_backend, slot_held=slot_held)
+    regions = [
+        ({
+            "x": int(fa.get("x", 0) / UPSCALE_FACTOR),
+            "y": int(fa.get("y", 0) / UPSCALE_FACTOR),
+            "w": int(fa.get("w", 0) / UPSCALE_FACTOR),
+            "h": int(fa.get("h", 0) / UPSCALE_FACTOR)
+        }, confidence)
+        for fa, confidence in regions
+    ]
+    return faces, regions
+
+
+def detect_faces_robust(img, detector_backend, stats=None):
+    """
+    Detect faces with multiple strategies for better recall.
+    Tries different approaches to maximize face detection.
+    Faces from all strategies are deduplicated first and then embedded
+    together in a single ArcFace forward pass.
+    stats from preprocess_for_detection skips upscaling dark images, where it
+    would only magnify CLAHE-amplified noise.
+    """
+    all_faces = []  # Aligned face crops from every strategy
+    all_regions = []  # Matching (facial_area, confidence) in original coordinates
+    priorities = []  # Standard detections win over upscaled duplicates
+
+    # Strategy 2 only helps images small enough to upscale, and only if
+    # Strategy 1 finds few faces
+    h, w = img.shape[:2]
+    upscale = max(h, w) < 1200 and (stats is None or stats["mean"] > UPSCALE_MIN_BRIGHTNESS)
+
+    # Hash the pixels once for both caches
+    aligned_key = key = None
+    if aligned_face_cache is not None or DETECTION_CACHE_SIZE > 0:
+        aligned_key = AlignedFaceCache.key(img, detector_backend, False)
+    if DETECTION_CACHE_SIZE > 0:
+        key = (aligned_key, upscale)
+        with detection_cache_lock:
+            cached = detection_cache.get(key)
+            if cached is not None:
+                detection_cache.move_to_end(key)
+        if cached is not None:
+            print(f"[DEBUG] Detection cache hit ({len(cached)} faces)")
+            # Fresh dicts, so callers may edit them; embeddings are read-only
+            return [{**det, "facial_area": dict(det["facial_area"])} for det in cached]
+    failed = False  # A failed strategy may succeed on retry, so don't cache it
+
+    # When two detector slots are idle, start it now on one of them so its pass
+    # overlaps Strategy 1 (TF releases the GIL). Under load it waits for
+    # Strategy 1 instead of competing with the passes other requests need.
+    upscaled_future = None
+    if upscale and detect_semaphore.acquire(blocking=False):
+        if detect_semaphore.acquire(blocking=False):
+            detect_semaphore.release()  # Left for Strategy 1
+            upscaled_future = upscale_pool.submit(detect_upscaled, img, detector_backend, True)
+            # Frees the reserved slot when the pass ends or is cancelled unstarted
+            upscaled_future.add_done_callback(lambda _: detect_semaphore.release())
+        else:
+            detect_semaphore.release()
+    
+    # Strategy 1: Standard detection
+    try:
+        faces, regions = align_faces(img, detector_backend, cache_key=aligned_key)
+        all_faces.extend(faces)
+        all_regions.extend(regions)
+        priorities.extend([1.0] * len(regions))
+        print(f"[DEBUG] Strategy 1 (standard): Found {len(regions)} faces")
+    except Exception as e:
+        failed = True
+        print(f"[DEBUG] Strategy 1 failed: {e}")
     
-    return all_detections
+    # Strategy 2: Use the upscaled pass if few faces found
+    if upscale:
+        if len(all_regions) < 3:
+            try:
+                if upscaled_future is not None:
+                    faces, regions = upscaled_future.result()
+                else:
+                    faces, regions = detect_upscaled(img, detector_backend)
+                all_faces.extend(faces)
+                all_regions.extend(regions)
+                priorities.extend([0.0] * len(regions))
+                print(f"[DEBUG] Strategy 2 (upscaled): Found {len(regions)} additional faces")
+            except Exception as e:
+                failed = True
+                print(f"[DEBUG] Strategy 2 failed: {e}")
+        elif upscaled_future is not None:
+            upscaled_future.cancel()  # No-op if already running; the result is unused
+
+    if not all_regions:
+        return [] if failed else cache_detections(key, [])
+
+    # Drop the same face found by both strategies: IoU NMS over all boxes, where
+    # confidence (0-1) plus priority keeps the standard detection of each face
+    boxes = np.array([
+        [fa["x"], fa["y"], fa["x"] + fa["w"], fa["y"] + fa["h"], float(confidence) + priority]
+        for (fa, confidence), priority in zip(all_regions, priorities)
+    ], dtype=np.float64)
+    keep = sorted(nms_boxes(boxes, DEDUP_IOU_THRESHOLD))
+    if len(keep) < len(all_regions):
+        print(f"[DEBUG] Removed {len(all_regions) - len(keep)} duplicate detections")
+
+    detections = embed_aligned_regions(np.stack([all_faces[i] for i in keep]), [all_regions[i] for i in keep])
+    return detections if failed else cache_detections(key, detections)
+
+
+def cache_detections(key, detections):
+    """Store detect_faces_robust output, returning copies for the caller"""
+    if key is None:
+        return detections
+    for det in detections:
+        det["embedding"].setflags(write=False)
+    with detection_cache_lock:
+        detection_cache[key] = detections
+        while len(detection_cache) > DETECTION_CACHE_SIZE:
+            detection_cache.popitem(last=False)
+    return [{**det, "facial_area": dict(det["facial_area"])} for det in detections]
 
 
 def scale_facial_area(facial_area, scale):
@@ -259,34 +1234,40 @@ def scale_facial_area(facial_area, scale):
 @app.route("/health", methods=["GET"])
 def health_check():
     """Health check endpoint"""
-    return jsonify({"status": "ok", "model": MODEL_NAME, "detector": DETECTOR_BACKEND})
+    return jsonify({
+        "status": "ok",
+        "model": MODEL_NAME,
+        "detector": DETECTOR_BACKEND,
+        "runtime": "onnxruntime" if arcface_session is not None else "keras"
+    })
 
 
 @app.route("/extract-embedding", methods=["POST"])
 def extract_embedding():
     """
     Extract face embedding from a single image.
-    Expects JSON with either 'image_path' or 'image_base64'
+    Expects JSON with either 'image_path' or 'image_base64' (or a raw/multipart 'image' upload)
     Returns the face embedding as a list of floats
+    (or {int8, scale} with optional 'embedding_format': 'int8')
     """
     try:
-        data = request.get_json()
+        data, images = get_request_payload()
         
-        if "image_path" in data:
+        if "image" in images:
+            img = load_image_from_bytes(images["image"], max_dim=ENROLL_MAX_DIM)
+        elif "image_path" in data:
             img = load_image_from_path(data["image_path"])
         elif "image_base64" in data:
-            img = load_image_from_base64(data["image_base64"])
+            img = load_image_from_base64(data["image_base64"], max_dim=ENROLL_MAX_DIM)
         else:
             return jsonify({"error": "Either 'image_path' or 'image_base64' is required"}), 400
 
-        # Extract embedding using DeepFace
-        embeddings = DeepFace.represent(
-            img_path=img,
-            model_name=MODEL_NAME,
-            detector_backend=DETECTOR_BACKEND,
-            enforce_detection=True,
-            align=True
-        )
+        embedding_format = data.get("embedding_format", "float32")
+        if embedding_format not in EMBEDDING_FORMATS:
+            return jsonify({"error": f"'embedding_format' must be one of {list(EMBEDDING_FORMATS)}"}), 400
+
+        # Extract embedding (detect + align, then ArcFace)
+        embeddings = represent_enrollment_face(img)
 
         if not embeddings or len(embeddings) == 0:
             return jsonify({"error": "No face detected in the image"}), 400
@@ -297,12 +1278,12 @@ def extract_embedding():
 
         response = {
             "success": True,
-            "embedding": embedding,
+            "embedding": format_embedding(embedding, embedding_format),
             "embedding_size": len(embedding),
             "facial_area": facial_area,
             "model": MODEL_NAME
         }
-        return jsonify(convert_to_native(response))
+        return json_response(response)
 
     except ValueError as e:
         if "Face could not be detected" in str(e):
@@ -313,36 +1294,78 @@ def extract_embedding():
         return jsonify({"error": str(e)}), 500
 
 
+@app.route("/embed-aligned", methods=["POST"])
+def embed_aligned():
+    """
+    Extract face embedding from an image that is already a cropped, aligned face.
+    Skips detection and alignment entirely - one ArcFace forward pass.
+    Expects JSON with either 'image_path' or 'image_base64' (or a raw/multipart 'image' upload)
+    """
+    try:
+        data, images = get_request_payload()
+        
+        if "image" in images:
+            img = load_image_from_bytes(images["image"])
+        elif "image_path" in data:
+            img = load_image_from_path(data["image_path"])
+        elif "image_base64" in data:
+            img = load_image_from_base64(data["image_base64"])
+        else:
+            return jsonify({"error": "Either 'image_path' or 'image_base64' is required"}), 400
+
+        embedding_format = data.get("embedding_format", "float32")
+        if embedding_format not in EMBEDDING_FORMATS:
+            return jsonify({"error": f"'embedding_format' must be one of {list(EMBEDDING_FORMATS)}"}), 400
+
+        face = preprocess_aligned_face(img)
+        embedding = embed_faces(face[np.newaxis])[0]
+
+        response = {
+            "success": True,
+            "embedding": format_embedding(embedding, embedding_format),
+            "embedding_size": len(embedding),
+            "model": MODEL_NAME
+        }
+        return json_response(response)
+
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"error": str(e)}), 500
+
+
 @app.route("/detect-faces", methods=["POST"])
+@app.route("/detect-and-embed", methods=["POST"])
 def detect_faces():
     """
     Detect all faces in an image and extract their embeddings.
-    Expects JSON with either 'image_path' or 'image_base64'
+    Expects JSON with either 'image_path' or 'image_base64' (or a raw/multipart 'image' upload)
     Returns list of face embeddings with bounding boxes
     """
     try:
-        data = request.get_json()
+        data, images = get_request_payload()
         
-        if "image_path" in data:
+        if "image" in images:
+            img = load_image_from_bytes(images["image"], max_dim=ENROLL_MAX_DIM)
+        elif "image_path" in data:
             img = load_image_from_path(data["image_path"])
         elif "image_base64" in data:
-            img = load_image_from_base64(data["image_base64"])
+            img = load_image_from_base64(data["image_base64"], max_dim=ENROLL_MAX_DIM)
         else:
             return jsonify({"error": "Either 'image_path' or 'image_base64' is required"}), 400
 
-        # Extract all face embeddings
-        embeddings = DeepFace.represent(
-            img_path=img,
-            model_name=MODEL_NAME,
-            detector_backend=DETECTOR_BACKEND,
-            enforce_detection=False,  # Don't fail if no faces
-            align=True
-        )
+        embedding_format = data.get("embedding_format", "float32")
+        if embedding_format not in EMBEDDING_FORMATS:
+            return jsonify({"error": f"'embedding_format' must be one of {list(EMBEDDING_FORMATS)}"}), 400
+
+        # Extract all face embeddings in one batch
+        embeddings = represent_faces(img, DETECTOR_BACKEND)  # Don't fail if no faces
 
         faces = []
         for emb in embeddings:
             faces.append({
-                "embedding": emb["embedding"],
+                "embedding": format_embedding(emb["embedding"], embedding_format),
                 "facial_area": emb.get("facial_area", {}),
                 "confidence": emb.get("face_confidence", 0)
             })
@@ -353,7 +1376,7 @@ def detect_faces():
             "face_count": len(faces),
             "model": MODEL_NAME
         }
-        return jsonify(convert_to_native(response))
+        return json_response(response)
 
     except Exception as e:
         traceback.print_exc()
@@ -365,29 +1388,42 @@ def match_faces():
     """
     Match detected faces against enrolled face descriptors.
     Expects JSON with:
-    - 'image_path' or 'image_base64': The group photo
+    - 'image_path' or 'image_base64' (or a multipart 'image' part): The group photo
     - 'enrolled_faces': List of {rollNumber, descriptors: [[...]]}
+      (descriptors may also be {int8, scale} dicts from embedding_format='int8';
+      raw embeddings are fine, the service L2-normalizes them once when packing)
+    - 'include_embeddings' (optional, default false): add each face's embedding,
+      in 'embedding_format' (float32 or int8), e.g. to enroll corrected matches
     Returns matched faces with roll numbers and bounding boxes
     """
     try:
-        data = request.get_json()
+        data, images = get_request_payload()
         
-        if "image_path" in data:
+        if "image" in images:
+            img = load_image_from_bytes(images["image"])
+        elif "image_path" in data:
             img = load_image_from_path(data["image_path"], for_group_photo=True)
         elif "image_base64" in data:
             img = load_image_from_base64(data["image_base64"])
         else:
             return jsonify({"error": "Either 'image_path' or 'image_base64' is required"}), 400
 
-        enrolled_faces = data.get("enrolled_faces", [])
+        enrolled_faces = load_enrolled_faces(data.get("enrolled_faces"))
         if not enrolled_faces:
             return jsonify({"error": "No enrolled faces provided"}), 400
 
+        include_embeddings = data.get("include_embeddings", False)
+        if isinstance(include_embeddings, str):  # Query string / form field
+            include_embeddings = include_embeddings.lower() in ("1", "true", "yes")
+        embedding_format = data.get("embedding_format", "float32")
+        if embedding_format not in EMBEDDING_FORMATS:
+            return jsonify({"error": f"'embedding_format' must be one of {list(EMBEDDING_FORMATS)}"}), 400
+
         # Preprocess image for better detection
-        processed_img, scale = preprocess_for_detection(img)
+        processed_img, scale, stats = preprocess_for_detection(img)
 
         # Use robust detection with multiple strategies for group photos
-        detections = detect_faces_robust(processed_img, MODEL_NAME, DETECTOR_BACKEND)
+        detections = detect_faces_robust(processed_img, DETECTOR_BACKEND, stats=stats)
 
         if not detections:
             return jsonify({
@@ -406,60 +1442,32 @@ def match_faces():
         detections = sorted(detections, key=get_face_position)
         print(f"[DEBUG] Detected {len(detections)} faces, sorted by position")
         
-        # Log enrolled faces info for debugging
-        dimension_mismatches = []
-        for enrolled in enrolled_faces:
-            desc_count = len(enrolled.get("descriptors", []))
-            desc_dims = [len(d) for d in enrolled.get("descriptors", [])]
-            print(f"[DEBUG] Enrolled: {enrolled['rollNumber']} with {desc_count} descriptors, dims={desc_dims}")
-            # Check for potential dimension mismatches (ArcFace uses 512)
-            for dim in desc_dims:
-                if dim != 512:
-                    dimension_mismatches.append((enrolled['rollNumber'], dim))
-        
-        if dimension_mismatches:
-            print(f"[WARN] Found {len(dimension_mismatches)} enrolled faces with non-512-dim embeddings!")
-            print(f"[WARN] These students need to be re-enrolled: {[r[0] for r in dimension_mismatches]}")
-            print(f"[WARN] Use POST /enroll/re-embed to update all embeddings with current model")
+        # All enrolled descriptors in one normalized matrix (mismatched dims are
+        # skipped and reported while packing)
+        gallery, gallery_people, gallery_starts = pack_enrolled_faces(
+            enrolled_faces, len(detections[0]["embedding"])
+        )
+
+        # For each face and enrolled person, their BEST (minimum) distance: (faces, people)
+        if gallery_people:
+            distances = gallery_distances([det["embedding"] for det in detections], gallery)
+            person_distances = np.minimum.reduceat(distances, gallery_starts, axis=1)
 
         # Match each detected face against enrolled faces
-        def find_best_match(embedding, face_index):
+        def find_best_match(face_index):
             best = {"label": "unknown", "distance": float("inf")}
             second_best = {"label": "unknown", "distance": float("inf")}
-            embedding_np = np.array(embedding)
-            embedding_dim = len(embedding)
             
             # Track all candidates for debugging
             all_candidates = []
             
-            # For each enrolled person, find their BEST (minimum) distance
-            person_distances = {}
-
-            for enrolled in enrolled_faces:
-                roll_number = enrolled["rollNumber"]
-                descriptors = enrolled.get("descriptors", [])
-                
-                min_distance = float("inf")
-                for desc in descriptors:
-                    # Check for dimension mismatch (e.g., old 128-dim vs new 512-dim)
-                    if len(desc) != embedding_dim:
-                        print(f"[WARN] Dimension mismatch for {roll_number}: enrolled={len(desc)}, detected={embedding_dim}")
-                        continue
-                    
-                    desc_np = np.array(desc)
-                    # Cosine similarity -> distance
-                    cos_sim = np.dot(embedding_np, desc_np) / (np.linalg.norm(embedding_np) * np.linalg.norm(desc_np))
-                    distance = 1 - cos_sim
-                    
-                    if distance < min_distance:
-                        min_distance = distance
-                
-                if min_distance < float("inf"):
-                    person_distances[roll_number] = float(min_distance)
-                    all_candidates.append({"label": roll_number, "distance": float(min_distance)})
-            
-            # Sort candidates by distance
-            all_candidates.sort(key=lambda x: x["distance"])
+            # Keep only the closest few people (best, second best, debug log)
+            if gallery_people:
+                face_distances = person_distances[face_index]
+                all_candidates = [
+                    {"label": gallery_people[j]["rollNumber"], "distance": float(face_distances[j])}
+                    for j in top_k_indices(face_distances, MATCH_TOP_K)
+                ]
             
             # Get best and second best
             if len(all_candidates) >= 1:
@@ -468,7 +1476,7 @@ def match_faces():
                 second_best = all_candidates[1]
             
             # Log top candidates for debugging
-            top_candidates = [(c['label'], round(c['distance'], 3)) for c in all_candidates[:5]]
+            top_candidates = [(c['label'], round(c['distance'], 3)) for c in all_candidates]
             print(f"[DEBUG] Face #{face_index} candidates: {top_candidates}")
 
             # Check if match is confident enough
@@ -516,11 +1524,10 @@ def match_faces():
         label_winners = {}
 
         for i, detection in enumerate(detections):
-            embedding = detection["embedding"]
             facial_area = detection.get("facial_area", {})
             # Scale bounding box back to original image size
             facial_area = scale_facial_area(facial_area, scale)
-            match = find_best_match(embedding, i)
+            match = find_best_match(i)
 
             results.append({
                 "index": i,
@@ -544,13 +1551,17 @@ def match_faces():
                 label_winners.get(match["label"], {}).get("index") == result["index"]
             )
 
-            matches.append({
-                "facial_area": convert_to_native(result["facial_area"]),
+            entry = {
+                "facial_area": result["facial_area"],
                 "roll_number": match["label"] if is_winner else "unknown",
                 "distance": float(match["distance"]),
-                "is_recognized": is_winner,
-                "embedding": convert_to_native(detections[result["index"]]["embedding"])
-            })
+                "is_recognized": is_winner
+            }
+            if include_embeddings:
+                entry["embedding"] = format_embedding(
+                    detections[result["index"]]["embedding"], embedding_format
+                )
+            matches.append(entry)
 
         response = {
             "success": True,
@@ -558,7 +1569,7 @@ def match_faces():
             "face_count": len(detections),
             "recognized_count": len(label_winners)
         }
-        return jsonify(convert_to_native(response))
+        return json_response(response)
 
     except Exception as e:
         traceback.print_exc()
@@ -570,45 +1581,55 @@ def verify_faces():
     """
     Verify if two faces belong to the same person.
     Expects JSON with:
-    - 'image1_path' or 'image1_base64'
-    - 'image2_path' or 'image2_base64'
+    - 'image1_path' or 'image1_base64' (or a multipart 'image1' part)
+    - 'image2_path' or 'image2_base64' (or a multipart 'image2' part)
     """
     try:
-        data = request.get_json()
+        data, images = get_request_payload()
 
         # Load first image
-        if "image1_path" in data:
-            img1 = data["image1_path"]
+        if "image1" in images:
+            img1 = load_image_from_bytes(images["image1"])
+        elif "image1_path" in data:
+            img1 = load_image_from_path(data["image1_path"], for_group_photo=True)
         elif "image1_base64" in data:
             img1 = load_image_from_base64(data["image1_base64"])
         else:
             return jsonify({"error": "image1_path or image1_base64 required"}), 400
 
         # Load second image
-        if "image2_path" in data:
-            img2 = data["image2_path"]
+        if "image2" in images:
+            img2 = load_image_from_bytes(images["image2"])
+        elif "image2_path" in data:
+            img2 = load_image_from_path(data["image2_path"], for_group_photo=True)
         elif "image2_base64" in data:
             img2 = load_image_from_base64(data["image2_base64"])
         else:
             return jsonify({"error": "image2_path or image2_base64 required"}), 400
 
-        result = DeepFace.verify(
-            img1_path=img1,
-            img2_path=img2,
-            model_name=MODEL_NAME,
-            detector_backend=DETECTOR_BACKEND,
-            distance_metric=DISTANCE_METRIC
-        )
+        # Same result as DeepFace.verify (closest face pair across both images),
+        # but through the cached detect + align and the batched ArcFace pass
+        faces1 = represent_faces(img1, DETECTOR_BACKEND, enforce_detection=True)
+        faces2 = represent_faces(img2, DETECTOR_BACKEND, enforce_detection=True)
+        if not faces1 or not faces2:
+            return jsonify({"error": "No face detected in the image"}), 400
+
+        emb1 = np.array([f["embedding"] for f in faces1], dtype=np.float32)
+        emb2 = np.array([f["embedding"] for f in faces2], dtype=np.float32)
+        emb1 /= np.linalg.norm(emb1, axis=1, keepdims=True)
+        emb2 /= np.linalg.norm(emb2, axis=1, keepdims=True)
+        distance = float(1 - (emb1 @ emb2.T).max())
+        threshold = find_threshold(MODEL_NAME, DISTANCE_METRIC)
 
         response = {
             "success": True,
-            "verified": bool(result["verified"]),
-            "distance": float(result["distance"]),
-            "threshold": float(result["threshold"]),
-            "model": result["model"],
-            "detector": result["detector_backend"]
+            "verified": bool(distance <= threshold),
+            "distance": distance,
+            "threshold": float(threshold),
+            "model": MODEL_NAME,
+            "detector": DETECTOR_BACKEND
         }
-        return jsonify(convert_to_native(response))
+        return json_response(response)
 
     except Exception as e:
         traceback.print_exc()
@@ -620,27 +1641,30 @@ def diagnose_matching():
     """
     Diagnostic endpoint to analyze why a face might not be matching.
     Expects JSON with:
-    - 'image_path' or 'image_base64': The photo to analyze
+    - 'image_path' or 'image_base64' (or a multipart 'image' part): The photo to analyze
     - 'enrolled_faces': List of {rollNumber, name, descriptors: [[...]]}
+      (same formats as /match-faces; descriptors need not be normalized)
     Returns detailed matching analysis for each detected face
     """
     try:
-        data = request.get_json()
+        data, images = get_request_payload()
         
-        if "image_path" in data:
+        if "image" in images:
+            img = load_image_from_bytes(images["image"])
+        elif "image_path" in data:
             img = load_image_from_path(data["image_path"], for_group_photo=True)
         elif "image_base64" in data:
             img = load_image_from_base64(data["image_base64"])
         else:
             return jsonify({"error": "Either 'image_path' or 'image_base64' is required"}), 400
 
-        enrolled_faces = data.get("enrolled_faces", [])
+        enrolled_faces = load_enrolled_faces(data.get("enrolled_faces"))
         if not enrolled_faces:
             return jsonify({"error": "No enrolled faces provided"}), 400
 
         # Preprocess and detect
-        processed_img, scale = preprocess_for_detection(img)
-        detections = detect_faces_robust(processed_img, MODEL_NAME, DETECTOR_BACKEND)
+        processed_img, scale, stats = preprocess_for_detection(img)
+        detections = detect_faces_robust(processed_img, DETECTOR_BACKEND, stats=stats)
 
         if not detections:
             return jsonify({
@@ -650,47 +1674,42 @@ def diagnose_matching():
                 "recommendations": ["Try a clearer photo with better lighting"]
             })
 
+        # All enrolled descriptors in one normalized matrix
+        gallery, gallery_people, gallery_starts = pack_enrolled_faces(
+            enrolled_faces, len(detections[0]["embedding"])
+        )
+        descriptor_counts = np.diff(np.append(gallery_starts, len(gallery)))
+
+        # Distances from every face to ALL enrolled faces in one GEMM, per person (faces, people)
+        if gallery_people:
+            distances = gallery_distances([det["embedding"] for det in detections], gallery)
+            person_min_distances = np.minimum.reduceat(distances, gallery_starts, axis=1)
+            person_avg_distances = np.add.reduceat(distances, gallery_starts, axis=1) / descriptor_counts
+
         # Analyze each face
         face_analyses = []
         
         for i, detection in enumerate(detections):
-            embedding = detection["embedding"]
-            embedding_np = np.array(embedding)
-            embedding_dim = len(embedding)
             facial_area = detection.get("facial_area", {})
             facial_area = scale_facial_area(facial_area, scale)
             
-            # Calculate distances to ALL enrolled faces
             all_distances = []
-            for enrolled in enrolled_faces:
-                roll_number = enrolled["rollNumber"]
-                name = enrolled.get("name", roll_number)
-                descriptors = enrolled.get("descriptors", [])
-                
-                distances_to_person = []
-                for desc in descriptors:
-                    if len(desc) != embedding_dim:
-                        continue
-                    desc_np = np.array(desc)
-                    cos_sim = np.dot(embedding_np, desc_np) / (np.linalg.norm(embedding_np) * np.linalg.norm(desc_np))
-                    distance = 1 - cos_sim
-                    distances_to_person.append(float(distance))
-                
-                if distances_to_person:
-                    min_dist = min(distances_to_person)
-                    avg_dist = sum(distances_to_person) / len(distances_to_person)
+            if gallery_people:
+                min_distances = person_min_distances[i]
+                avg_distances = person_avg_distances[i]
+
+                # Closest people first (only the top few are reported)
+                for j in top_k_indices(min_distances, MATCH_TOP_K):
+                    roll_number = gallery_people[j]["rollNumber"]
                     all_distances.append({
                         "rollNumber": roll_number,
-                        "name": name,
-                        "minDistance": round(min_dist, 4),
-                        "avgDistance": round(avg_dist, 4),
-                        "numDescriptors": len(distances_to_person),
-                        "wouldMatch": min_dist <= FACE_MATCH_THRESHOLD
+                        "name": gallery_people[j].get("name", roll_number),
+                        "minDistance": round(float(min_distances[j]), 4),
+                        "avgDistance": round(float(avg_distances[j]), 4),
+                        "numDescriptors": int(descriptor_counts[j]),
+                        "wouldMatch": bool(min_distances[j] <= FACE_MATCH_THRESHOLD)
                     })
             
-            # Sort by minimum distance
-            all_distances.sort(key=lambda x: x["minDistance"])
-            
             # Determine match status
             best = all_distances[0] if all_distances else None
             second_best = all_distances[1] if len(all_distances) > 1 else None
@@ -731,7 +1750,7 @@ def diagnose_matching():
                     "requiredGap": required_gap,
                     "isMatch": is_match,
                     "matchedTo": best["name"] if is_match else "Unknown",
-                    "allCandidates": all_distances[:5],  # Top 5
+                    "allCandidates": all_distances,  # Top MATCH_TOP_K
                     "recommendations": recommendations
                 })
             else:
@@ -751,29 +1770,39 @@ def diagnose_matching():
             "maxGap": FACE_MATCH_GAP,
             "faces": face_analyses
         }
-        return jsonify(convert_to_native(response))
+        return json_response(response)
 
     except Exception as e:
         traceback.print_exc()
         return jsonify({"error": str(e)}), 500
 
 
-if __name__ == "__main__":
-    # Pre-load the model on startup
+def warm_up_models():
+    """Build the detector and run the full pipeline once so the first request is fast"""
     print("Pre-loading DeepFace model...")
     try:
         # Create a dummy image to trigger model loading
         dummy_img = np.zeros((224, 224, 3), dtype=np.uint8)
         dummy_img[50:174, 50:174] = 128  # Add some content
-        DeepFace.represent(
-            img_path=dummy_img,
-            model_name=MODEL_NAME,
-            detector_backend=DETECTOR_BACKEND,
-            enforce_detection=False
-        )
+        represent_faces(dummy_img, DETECTOR_BACKEND)
+
+        # Group-photo path: preprocessing and, at 400x400, the upscaled pass
+        group_img = np.full((400, 400, 3), 96, dtype=np.uint8)
+        group_img[100:300, 120:280] = 160
+        processed_img, _, stats = preprocess_for_detection(group_img)
+        detect_faces_robust(processed_img, DETECTOR_BACKEND, stats=stats)
         print(f"Model {MODEL_NAME} loaded successfully")
     except Exception as e:
         print(f"Model pre-load note: {e}")
 
+
+# Warm up at import so any server (not only `python app.py`) starts hot.
+# gunicorn.conf.py turns this off and warms up in post_worker_init instead.
+if os.environ.get("WARM_UP_ON_IMPORT", "1") == "1":
+    warm_up_models()
+
+
+if __name__ == "__main__":
+    # Development server. In production run: gunicorn -c gunicorn.conf.py app:app
     print("Starting DeepFace service on port 5001...")
     app.run(host="0.0.0.0", port=5001, debug=False)
@@ -0,0 +1,47 @@
+"""
+Export the ArcFace model used by the DeepFace service to ONNX.
+
+Usage:
+    pip install tf2onnx onnxruntime-gpu   # or onnxruntime for CPU-only
+    python export_onnx.py [output_path]   # default: arcface.onnx
+
+Then start the service with ARCFACE_ONNX_PATH=<output_path> (arcface.onnx next
+to app.py is picked up without it; the Docker image does this). On machines with
+TensorRT, ONNX Runtime builds an FP16 engine on first use and caches it next to
+the model file (trt_cache/), so only the first start pays the build cost.
+
+NOTE: Detection stays on DeepFace's RetinaFace; only the recognition forward pass
+is exported. Embeddings match the Keras model, so no re-enrollment is needed.
+"""
+
+import os
+import sys
+
+os.environ["TF_CPP_MIN_LOG_LEVEL"] = "2"
+
+import tensorflow as tf
+import tf2onnx
+from deepface import DeepFace
+
+MODEL_NAME = "ArcFace"
+OPSET = 17
+
+
+def export_arcface(output_path):
+    """Convert the Keras ArcFace model to ONNX with a dynamic batch dimension"""
+    client = DeepFace.build_model(MODEL_NAME)
+    h, w = client.input_shape
+
+    # Input name must match ARCFACE_ONNX_INPUT in app.py
+    input_signature = (tf.TensorSpec((None, h, w, 3), tf.float32, name="input"),)
+    tf2onnx.convert.from_keras(
+        client.model,
+        input_signature=input_signature,
+        opset=OPSET,
+        output_path=output_path
+    )
+    print(f"Exported {MODEL_NAME} ({h}x{w}, opset {OPSET}) to {output_path}")
+
+
+if __name__ == "__main__":
+    export_arcface(sys.argv[1] if len(sys.argv) > 1 else "arcface.onnx")
@@ -0,0 +1,46 @@
+"""
+Gunicorn configuration for the DeepFace service.
+
+A single worker process owns the models (and the GPU context). Its request
+threads overlap image decoding and preprocessing with inference, and the
+BatchedEmbedder in app.py merges their ArcFace calls into shared forward passes.
+
+Run: gunicorn -c gunicorn.conf.py app:app
+"""
+
+import os
+import threading
+
+bind = "0.0.0.0:5001"
+# More processes only help CPU-only hosts with cores to spare (split them with
+# TF_INTRA_OP_THREADS); each worker loads its own models and caches.
+workers = int(os.environ.get("GUNICORN_WORKERS", "1"))
+worker_class = "gthread"
+# Not preloaded: app.py initializes TensorFlow/ONNX Runtime (thread pools, CUDA
+# context) at import, and that state does not survive fork() into the workers.
+# Copy-on-write sharing would not hold for long either, as refcount updates
+# touch the pages holding the model objects.
+preload_app = False
+# Request threads mostly wait on I/O and the batcher, but detection runs in them
+# too - on CPU-only hosts, budget TF_INTRA_OP_THREADS with the remaining cores
+# in mind (see app.py) rather than letting every thread use every core.
+threads = int(os.environ.get("GUNICORN_THREADS", "16"))
+
+# CPU-only group photos can take a while
+timeout = 120
+
+# Warm the models up in post_worker_init rather than at import, so the
+# first-request tracing does not count against `timeout` (the weights themselves
+# are baked into the image, see the Dockerfile)
+os.environ.setdefault("WARM_UP_ON_IMPORT", "0")
+
+
+def post_worker_init(worker):
+    """Run app.warm_up_models() while keeping the worker's heartbeat alive"""
+    from app import warm_up_models
+
+    warm_up = threading.Thread(target=warm_up_models, daemon=True)
+    warm_up.start()
+    while warm_up.is_alive():
+        worker.notify()
+        warm_up.join(timeout / 4)
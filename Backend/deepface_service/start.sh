@@ -17,5 +17,5 @@ else
 fi
 
 echo
-echo "Starting Flask server on port 5001..."
-python app.py
+echo "Starting DeepFace service on port 5001 (gunicorn)..."
+gunicorn -c gunicorn.conf.py app:app
@@ -0,0 +1,117 @@
+"""
+Tests for the pure NumPy/OpenCV helpers in app.py, checked against the
+straightforward implementations they replace.
+
+Importing app loads the models (without warm-up), so DeepFace must be installed.
+Run: python -m pytest test_app.py
+"""
+
+import os
+
+import numpy as np
+import pytest
+
+# Captured before app replaces it with nms_boxes
+postprocess = pytest.importorskip("retinaface.commons.postprocess")
+retinaface_cpu_nms = postprocess.cpu_nms
+
+os.environ.setdefault("WARM_UP_ON_IMPORT", "0")
+app = pytest.importorskip("app")
+
+
+def random_boxes(rng, count, size=400):
+    """(count, 5) [x1, y1, x2, y2, score] rows, many of them overlapping"""
+    x1 = rng.uniform(0, size, count)
+    y1 = rng.uniform(0, size, count)
+    w = rng.uniform(5, 80, count)
+    h = rng.uniform(5, 80, count)
+    scores = rng.uniform(0, 1, count)
+    return np.stack([x1, y1, x1 + w, y1 + h, scores], axis=1).astype(np.float32)
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("threshold", [0.3, 0.4, 0.5])
+def test_nms_boxes_matches_retinaface(seed, threshold):
+    dets = random_boxes(np.random.default_rng(seed), 300)
+    assert list(app.nms_boxes(dets, threshold)) == list(retinaface_cpu_nms(dets, threshold))
+
+
+def test_nms_boxes_single_and_empty():
+    dets = np.array([[10, 10, 50, 50, 0.9]], dtype=np.float32)
+    assert list(app.nms_boxes(dets, 0.4)) == [0]
+    assert list(app.nms_boxes(np.zeros((0, 5), dtype=np.float32), 0.4)) == []
+
+
+def pil_align_crop(img, facial_area, left_eye, right_eye, rotate_facial_area):
+    """DeepFace's own path: rotate the whole image with PIL, then crop"""
+    from PIL import Image
+
+    angle = float(np.degrees(np.arctan2(right_eye[1] - left_eye[1], right_eye[0] - left_eye[0])))
+    rotated = np.array(Image.fromarray(img).rotate(angle))
+    x1, y1, x2, y2 = rotate_facial_area(facial_area=facial_area, angle=angle, size=img.shape[:2])
+    return rotated[int(y1):int(y2), int(x1):int(x2)]
+
+
+@pytest.mark.parametrize("eye_dy", [0, 4, -9, 17, -30])
+@pytest.mark.parametrize("facial_area", [
+    (150, 120, 250, 250), (60, 200, 130, 290), (300, 40, 380, 130),
+    (200, 120, 200, 250), (150, 180, 250, 180),  # Degenerate boxes give empty crops
+])
+def test_align_face_crop_matches_pil_rotation(facial_area, eye_dy):
+    from deepface.detectors.DetectorWrapper import rotate_facial_area
+
+    img = np.random.default_rng(0).integers(0, 256, (360, 480, 3), dtype=np.uint8)
+    x1, y1, x2, _ = facial_area
+    left_eye = (x1 + (x2 - x1) // 4, y1 + 30)
+    right_eye = (x2 - (x2 - x1) // 4, y1 + 30 + eye_dy)
+
+    expected = pil_align_crop(img, facial_area, left_eye, right_eye, rotate_facial_area)
+    face = app.align_face_crop(img, facial_area, left_eye, right_eye, rotate_facial_area)
+    assert face.shape == expected.shape
+    # Nearest-neighbour rounding may pick a neighbouring source pixel at a few spots
+    mismatched = np.any(face != expected, axis=-1)
+    assert mismatched.sum() <= 0.01 * mismatched.size
+
+
+def test_align_face_crop_without_eyes_is_a_plain_crop():
+    from deepface.detectors.DetectorWrapper import rotate_facial_area
+
+    img = np.random.default_rng(1).integers(0, 256, (100, 120, 3), dtype=np.uint8)
+    face = app.align_face_crop(img, (10, 20, 60, 90), None, None, rotate_facial_area)
+    assert np.array_equal(face, img[20:90, 10:60])
+
+
+@pytest.mark.parametrize("k", [1, 3, 5, 50])
+def test_top_k_indices_matches_stable_argsort(k):
+    rng = np.random.default_rng(k)
+    values = rng.integers(0, 6, 40).astype(np.float32)  # Plenty of ties
+    expected = np.argsort(values, kind="stable")[:k]
+    assert list(app.top_k_indices(values, k)) == list(expected)
+
+
+def cosine_distance(a, b):
+    a, b = np.asarray(a, dtype=np.float64), np.asarray(b, dtype=np.float64)
+    return 1 - a @ b / (np.linalg.norm(a) * np.linalg.norm(b))
+
+
+def test_packed_gallery_reduceat_matches_per_person_loop():
+    rng = np.random.default_rng(7)
+    enrolled = [
+        {"rollNumber": f"R{i}", "descriptors": rng.normal(size=(rng.integers(1, 5), 512)).tolist()}
+        for i in range(12)
+    ]
+    enrolled[3]["descriptors"] = []  # Not enrolled yet
+    enrolled[5]["descriptors"].append([0.1] * 128)  # Stale descriptor from another model
+    probes = rng.normal(size=(4, 512)).tolist()
+
+    matrix, people, starts = app.pack_enrolled_faces(enrolled, 512)
+    person_min = np.minimum.reduceat(app.gallery_distances(probes, matrix), starts, axis=1)
+
+    expected_people = [p for p in enrolled if any(len(d) == 512 for d in p["descriptors"])]
+    assert [p["rollNumber"] for p in people] == [p["rollNumber"] for p in expected_people]
+    expected = [
+        [min(cosine_distance(probe, d) for d in person["descriptors"] if len(d) == 512)
+         for person in expected_people]
+        for probe in probes
+    ]
+    np.testing.assert_allclose(person_min, expected, atol=1e-5)
@@ -83,6 +83,22 @@ function cleanupOldMarkedImages(maxAgeMinutes = 30) {
 cleanupOldMarkedImages();
 setInterval(() => cleanupOldMarkedImages(), 30 * 60 * 1000);
 
+/**
+ * Build the multipart body for a local DeepFace request.
+ * enrolled_faces goes in its own field as raw JSON text: the service hashes it
+ * and reuses the parsed, packed class gallery until the descriptors change.
+ * (The Hugging Face service only accepts JSON, so remote calls don't use this.)
+ */
+function buildLocalDeepFaceForm(imagePath, enrolledFaces, fields = {}) {
+    const form = new FormData();
+    form.append("image_path", imagePath);
+    form.append("enrolled_faces", JSON.stringify(enrolledFaces));
+    for (const [name, value] of Object.entries(fields)) {
+        form.append(name, String(value));
+    }
+    return form;
+}
+
 /**
  * Call DeepFace service to match faces in a group photo against enrolled faces
  * Supports both local (file path) and remote (base64) modes
@@ -97,6 +113,7 @@ async function matchFaces(imagePath, enrolledFaces) {
     console.log(`[DeepFace] Matching faces from: ${absolutePath} (remote: ${isRemoteDeepFace})`);
     
     let requestBody;
+    let headers = {};
     
     if (isRemoteDeepFace) {
         // Remote service: send base64 encoded image
@@ -104,19 +121,20 @@ async function matchFaces(imagePath, enrolledFaces) {
         const base64Image = imageBuffer.toString('base64');
         requestBody = JSON.stringify({
             image_base64: base64Image,
-            enrolled_faces: enrolledFaces
+            enrolled_faces: enrolledFaces,
+            include_embeddings: true // Needed to add corrected faces to training
         });
+        headers = { "Content-Type": "application/json" };
     } else {
-        // Local service: send file path
-        requestBody = JSON.stringify({
-            image_path: absolutePath,
-            enrolled_faces: enrolledFaces
+        // Local service: send file path (fetch sets the multipart Content-Type)
+        requestBody = buildLocalDeepFaceForm(absolutePath, enrolledFaces, {
+            include_embeddings: true // Needed to add corrected faces to training
         });
     }
     
     const response = await fetch(`${DEEPFACE_SERVICE_URL}/match-faces`, {
         method: "POST",
-        headers: { "Content-Type": "application/json" },
+        headers,
         body: requestBody
     });
 
@@ -641,6 +659,7 @@ router.post("/diagnose", authMiddleware, upload.single("groupPhoto"), async (req
 
         // Call DeepFace diagnose endpoint
         let requestBody;
+        let headers = {};
         
         if (isRemoteDeepFace) {
             // Remote service: send base64 encoded image
@@ -650,17 +669,15 @@ router.post("/diagnose", authMiddleware, upload.single("groupPhoto"), async (req
                 image_base64: base64Image,
                 enrolled_faces: enrolledFaces
             });
+            headers = { "Content-Type": "application/json" };
         } else {
-            // Local service: send file path
-            requestBody = JSON.stringify({
-                image_path: absoluteImagePath,
-                enrolled_faces: enrolledFaces
-            });
+            // Local service: send file path (shares the cached class gallery with /match-faces)
+            requestBody = buildLocalDeepFaceForm(absoluteImagePath, enrolledFaces);
         }
         
         const response = await fetch(`${DEEPFACE_SERVICE_URL}/diagnose`, {
             method: "POST",
-            headers: { "Content-Type": "application/json" },
+            headers,
             body: requestBody
         });
 
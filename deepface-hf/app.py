@@ -10,8 +10,13 @@ MODELS USED (same as local version):
 import os
 # Optimize TensorFlow BEFORE importing
 os.environ["TF_CPP_MIN_LOG_LEVEL"] = "2"  # Suppress TF warnings
-os.environ["TF_DETERMINISTIC_OPS"] = "1"
-os.environ["TF_CUDNN_DETERMINISTIC"] = "1"
+# Deterministic ops force slower cuDNN conv algorithms and disable autotuning.
+# Weights are fixed, so embeddings are already stable for matching; opt in with
+# SNAPTICK_DETERMINISTIC=1 only when bit-identical output is needed (debugging).
+DETERMINISTIC = os.environ.get("SNAPTICK_DETERMINISTIC") == "1"
+if DETERMINISTIC:
+    os.environ["TF_DETERMINISTIC_OPS"] = "1"
+    os.environ["TF_CUDNN_DETERMINISTIC"] = "1"
 
 from flask import Flask, request, jsonify
 from deepface import DeepFace
@@ -23,7 +28,9 @@ import traceback
 # Check GPU/CPU
 try:
     import tensorflow as tf
-    tf.config.experimental.enable_op_determinism()
+    if DETERMINISTIC:
+        tf.config.experimental.enable_op_determinism()
+        print("TensorFlow deterministic mode enabled")
     gpus = tf.config.list_physical_devices('GPU')
     if gpus:
         print(f"GPU detected: {gpus}")
@@ -31,7 +38,6 @@ try:
             tf.config.experimental.set_memory_growth(gpu, True)
     else:
         print("No GPU detected, using CPU")
-    print("TensorFlow deterministic mode enabled")
 except Exception as e:
     print(f"GPU setup note: {e}")
 